@@ -11,6 +11,9 @@ logger = logging.getLogger(__name__)
 # always internally joins "params". (We should probably patch alphafold)
 default_data_dir = Path(appdirs.user_cache_dir(__package__ or "colabfold"))
 
+# Pinned, so that GPU searches stay reproducible across installations
+MMSEQS_GPU_VERSION = "16-747c6"
+
 
 def download_alphafold_params(model_type: str, data_dir: Path = default_data_dir):
     import requests
@@ -53,6 +56,32 @@ def download_alphafold_params(model_type: str, data_dir: Path = default_data_dir
     success_marker.touch()
 
 
+def download_mmseqs_gpu(data_dir: Path = default_data_dir) -> Path:
+    """Download the CUDA build of MMseqs2 and return the path to its binary"""
+    import requests
+
+    mmseqs_dir = data_dir.joinpath(f"mmseqs-gpu-{MMSEQS_GPU_VERSION}")
+    mmseqs_bin = mmseqs_dir.joinpath("mmseqs", "bin", "mmseqs")
+    success_marker = mmseqs_dir.joinpath("download_finished.txt")
+    if success_marker.is_file():
+        return mmseqs_bin
+
+    mmseqs_dir.mkdir(parents=True, exist_ok=True)
+    url = f"https://github.com/soedinglab/MMseqs2/releases/download/{MMSEQS_GPU_VERSION}/mmseqs-linux-gpu.tar.gz"
+    response = requests.get(url, stream=True)
+    file_size = int(response.headers.get("Content-Length", 0))
+    with tqdm.tqdm.wrapattr(
+        response.raw,
+        "read",
+        total=file_size,
+        desc=f"Downloading MMseqs2-GPU {MMSEQS_GPU_VERSION} to {mmseqs_dir}",
+    ) as response_raw:
+        file = tarfile.open(fileobj=response_raw, mode="r|gz")
+        file.extractall(path=mmseqs_dir)
+    success_marker.touch()
+    return mmseqs_bin
+
+
 if __name__ == "__main__":
     # TODO: Arg to select which one
     download_alphafold_params("alphafold2_multimer_v3")
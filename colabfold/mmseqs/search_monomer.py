@@ -12,25 +12,217 @@ Note: Currently needs mmseqs compiled from source
     get output alignment
 """
 
+import atexit
 import logging
 import math
 import os
+import platform
+import re
 import shutil
+import signal
 import subprocess
+import sys
+import tempfile
 from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from colabfold.batch import get_queries, msa_to_str
+from colabfold.download import download_mmseqs_gpu
 from colabfold.utils import safe_filename
 
 logger = logging.getLogger(__name__)
 
+# Parameters that are the same for every call, the call specific ones are added in the search functions
+# fmt: off
+SEARCH_PARAMS = ("-a", "-e", "0.1", "--max-seqs", "10000")
+FILTER_PARAMS = ("--qid", "0.0,0.2,0.4,0.6,0.8,1.0", "--qsc", "0", "--max-seq-id", "0.95")
+EXPAND_PARAMS = ("--expansion-mode", "0", "--max-seq-id", "0.95")
+# fmt: on
+
+
+def is_gpu_db(dbbase: Path, db: Path) -> bool:
+    """Whether db was built for MMseqs2-GPU (e.g. with GPU=1 setup_databases.sh).
+
+    MMseqs2 marks padded GPU databases with the DBTYPE_EXTENDED_GPU flag (8) in the upper 16 bits
+    of the dbtype.
+    """
+    for suffix in ["", "_seq", ".idx"]:
+        dbtype_file = dbbase.joinpath(f"{db}{suffix}.dbtype")
+        if not dbtype_file.is_file():
+            continue
+        dbtype = int.from_bytes(dbtype_file.read_bytes()[:4], "little")
+        if (dbtype >> 16) & 8:
+            return True
+    return False
+
+
+def cpu_isas() -> List[str]:
+    """Instruction sets of the host for which MMseqs2 ships a build, fastest first"""
+    if platform.machine() in ["aarch64", "arm64"]:
+        return ["arm64"]
+    flags = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    break
+    except OSError:
+        pass
+    isas = []
+    if "avx2" in flags:
+        isas.append("avx2")
+    if "sse4_1" in flags:
+        isas.append("sse41")
+    isas.append("sse2")
+    return isas
+
+
+@lru_cache(maxsize=None)
+def resolve_mmseqs(mmseqs: Path) -> Path:
+    """Pick the fastest mmseqs_<isa> build (e.g. mmseqs_avx2) located next to the given binary.
+
+    Set MMSEQS_ISA (avx2, sse41, sse2 or arm64) to force a specific build. If no such build exists,
+    the given binary is used as is.
+    """
+    located = shutil.which(str(mmseqs))
+    if located is None:
+        return mmseqs
+    forced_isa = os.environ.get("MMSEQS_ISA")
+    for isa in [forced_isa] if forced_isa else cpu_isas():
+        candidate = Path(located).parent.joinpath(f"mmseqs_{isa}")
+        if candidate.is_file():
+            logger.info(f"Using {candidate}")
+            return candidate
+    if forced_isa:
+        logger.warning(
+            f"MMSEQS_ISA={forced_isa} is set, but there is no mmseqs_{forced_isa} next to {located}"
+        )
+    return mmseqs
+
+
+def mmseqs_env(params: List[Union[str, Path]]) -> Dict[str, str]:
+    """Environment for mmseqs that sizes the OpenMP thread pool after --threads.
+
+    Settings already present in the environment take precedence.
+    """
+    env = os.environ.copy()
+    if "--threads" in params:
+        env.setdefault("OMP_NUM_THREADS", str(params[params.index("--threads") + 1]))
+    return env
+
 
 def run_mmseqs(mmseqs: Path, params: List[Union[str, Path]]):
+    mmseqs = resolve_mmseqs(mmseqs)
     params_log = " ".join(str(i) for i in params)
     logger.info(f"Running {mmseqs} {params_log}")
-    subprocess.check_call([mmseqs] + params)
+    subprocess.check_call([mmseqs] + params, env=mmseqs_env(params))
+
+
+def rmdb_local(db: Path):
+    """Remove an MMseqs2 database and its companion files without spawning `mmseqs rmdb`"""
+    suffixes = ["", ".index", ".dbtype", ".lookup", ".source", "_h", "_h.index", "_h.dbtype"]
+    for suffix in suffixes:
+        try:
+            db.parent.joinpath(db.name + suffix).unlink()
+        except FileNotFoundError:
+            pass
+    # data files of databases that were written in parts
+    for file in db.parent.glob(f"{db.name}.[0-9]*"):
+        file.unlink()
+
+
+def mvdb_local(src: Path, dst: Path):
+    """Rename an MMseqs2 database without spawning `mmseqs mvdb`"""
+    parts = list(src.parent.glob(f"{src.name}.[0-9]*"))
+    if not src.exists() and not parts:
+        raise FileNotFoundError(f"Database {src} does not exist")
+    for suffix in ["", ".index", ".dbtype", ".lookup", ".source"]:
+        file = src.parent.joinpath(src.name + suffix)
+        if file.exists():
+            os.rename(file, dst.parent.joinpath(dst.name + suffix))
+    for file in parts:
+        os.rename(file, dst.parent.joinpath(dst.name + file.name[len(src.name) :]))
+
+
+def lndb_local(src: Path, dst: Path):
+    """Symlink an MMseqs2 database without spawning `mmseqs lndb`"""
+    for suffix in ["", ".index", ".dbtype"]:
+        file = src.parent.joinpath(src.name + suffix)
+        link = dst.parent.joinpath(dst.name + suffix)
+        # replace leftovers of an earlier run into the same directory
+        if link.is_symlink() or link.exists():
+            link.unlink()
+        if file.exists():
+            os.symlink(file.resolve(), link)
+
+
+def evict_page_cache(db: Path):
+    """Drop the cached pages of the data file of an intermediate database that is not read again,
+    so they don't push the pages of the target database out of the page cache"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(db, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def unlink_prefixed(directory: Path, prefix: str):
+    """Delete all files in directory whose name starts with prefix, with a single directory scan"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix):
+                os.unlink(entry.path)
+
+
+@lru_cache(maxsize=None)
+def process_shm_dir(shm_base: Path = Path("/dev/shm")) -> Path:
+    """Shared memory directory private to this process, removed when python exits.
+
+    SIGTERM (e.g. a SLURM timeout or scancel) is turned into SystemExit so the directory is removed
+    then as well. After SIGKILL or an OOM kill it remains and has to be removed by hand.
+    """
+    shm_dir = Path(tempfile.mkdtemp(prefix="colabfold_mmseqs_", dir=shm_base))
+    atexit.register(shutil.rmtree, shm_dir, ignore_errors=True)
+    logger.info(f"Staging databases in {shm_dir}, remove it by hand if the search gets killed")
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    except ValueError:
+        # Signal handlers can only be set from the main thread
+        logger.warning(f"Could not install a SIGTERM handler, {shm_dir} is not removed on SIGTERM")
+    return shm_dir
+
+
+@lru_cache(maxsize=None)
+def stage_db_in_shm(dbbase: Path, db: Path) -> Path:
+    """Copy the index of a database into shared memory and symlink its remaining files next to it.
+
+    Returns the directory to use as dbbase from now on. The copy is removed when python exits.
+    """
+    shm_dir = process_shm_dir()
+    for file in dbbase.glob(f"{db}*"):
+        target = shm_dir.joinpath(file.name)
+        if target.exists() or target.is_symlink():
+            continue
+        if file.name.startswith(f"{db}.idx"):
+            logger.info(f"Copying {file} to {shm_dir}")
+            # Only complete copies get the final name
+            partial = shm_dir.joinpath(f"{file.name}.partial")
+            shutil.copyfile(file, partial)
+            os.replace(partial, target)
+        else:
+            target.symlink_to(file.resolve())
+    return shm_dir
 
 
 def mmseqs_search_monomer(
@@ -46,17 +238,31 @@ def mmseqs_search_monomer(
     expand_eval: float = math.inf,
     align_eval: int = 10,
     diff: int = 3000,
+    filter_min_enable: int = 1000,
     qsc: float = -20.0,
     max_accept: int = 1000000,
     s: float = 8,
+    num_iterations: Optional[int] = None,
     db_load_mode: int = 2,
     threads: int = 32,
+    gpu: int = 0,
+    gpu_server: int = 0,
+    use_shm: bool = False,
+    keep_intermediate: bool = False,
 ):
     """Run mmseqs with a local colabfold database set
 
     db1: uniprot db (UniRef30)
     db2: Template (unused by default)
     db3: metagenomic db (colabfold_envdb_202108 or bfd_mgy_colabfold, the former is preferred)
+
+    With keep_intermediate, the realigned search result (res_exp_realign) is left in base, so that
+    mmseqs_search_pair can start from it directly. Only set it if mmseqs_search_pair runs
+    afterwards, which removes it again.
+
+    base must contain the query database qdb with all queries of the batch. MMseqs2 streams the
+    target database once per call regardless of the number of queries, so call this once per
+    batch instead of once per job.
     """
     if filter:
         # 0.1 was not used in benchmarks due to POSIX shell bug in line above
@@ -64,70 +270,132 @@ def mmseqs_search_monomer(
         align_eval = 10
         qsc = 0.8
         max_accept = 100000
+    if num_iterations is None:
+        # At low sensitivity, the later profile iterations add few hits that survive filtering,
+        # while each one costs as much as the first prefilter pass (see the MMseqs2 user guide)
+        num_iterations = 1 if filter and s is not None and s <= 4 else 3
 
+    # Only UniRef is searched, the template and environmental searches are disabled for now
     used_dbs = [uniref_db]
-    if use_templates:
-        used_dbs.append(template_db)
-    if use_env:
-        used_dbs.append(metagenomic_db)
 
+    db_suffixes: Dict[Path, Tuple[str, str]] = {}
     for db in used_dbs:
-        if not dbbase.joinpath(f"{db}.dbtype").is_file():
+        if not os.path.isfile(dbbase.joinpath(f"{db}.dbtype")):
             raise FileNotFoundError(f"Database {db} does not exist")
-        if (
-            not dbbase.joinpath(f"{db}.idx").is_file()
-            and not dbbase.joinpath(f"{db}.idx.index").is_file()
+        if os.path.isfile(dbbase.joinpath(f"{db}.idx")) or os.path.isfile(
+            dbbase.joinpath(f"{db}.idx.index")
         ):
-            logger.info("Search does not use index")
-            db_load_mode = 0
-            dbSuffix1 = "_seq"
-            dbSuffix2 = "_aln"
+            db_suffixes[db] = (".idx", ".idx")
         else:
-            dbSuffix1 = ".idx"
-            dbSuffix2 = ".idx"
+            logger.info(f"Search of {db} does not use index")
+            db_load_mode = 0
+            db_suffixes[db] = ("_seq", "_aln")
+    dbSuffix1, dbSuffix2 = db_suffixes[uniref_db]
+
+    if use_shm:
+        for db in used_dbs:
+            shm_dbbase = stage_db_in_shm(dbbase, db)
+        dbbase = shm_dbbase
+        if dbSuffix1 == ".idx":
+            # mmap and touch the in-memory copy of the index, so consecutive calls don't reload it
+            db_load_mode = 3
 
     # fmt: off
     # @formatter:off
-    search_param = ["--num-iterations", "3", "--db-load-mode", str(db_load_mode), "-a", "-e", "0.1", "--max-seqs", "10000"]
-    if s is not None:
-        search_param += ["-s", "{:.1f}".format(s)]
+    search_param = ["--num-iterations", str(num_iterations), "--db-load-mode", str(db_load_mode), *SEARCH_PARAMS]
+    if gpu:
+        # The GPU prefilter is ungapped only and ignores the k-mer sensitivity settings
+        search_param += ["--gpu", str(gpu), "--gpu-server", str(gpu_server), "--prefilter-mode", "1"]
+    elif s is not None:
+        search_param += ["-s", f"{s:.1f}"]
     else:
         search_param += ["--k-score", "'seq:96,prof:80'"]
-    filter_param = ["--filter-msa", str(filter), "--filter-min-enable", "1000", "--diff", str(diff), "--qid", "0.0,0.2,0.4,0.6,0.8,1.0", "--qsc", "0", "--max-seq-id", "0.95",]
-    expand_param = ["--expansion-mode", "0", "-e", str(expand_eval), "--expand-filter-clusters", str(filter), "--max-seq-id", "0.95",]
+    filter_param = ["--filter-msa", str(filter), "--filter-min-enable", str(filter_min_enable), "--diff", str(diff), *FILTER_PARAMS]
+    expand_param = ["-e", str(expand_eval), "--expand-filter-clusters", str(filter), *EXPAND_PARAMS]
 
     run_mmseqs(mmseqs, ["search", base.joinpath("qdb"), dbbase.joinpath(uniref_db), base.joinpath("res"), base.joinpath("tmp"), "--threads", str(threads)] + search_param)
-    run_mmseqs(mmseqs, ["mvdb", base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res")])
-    run_mmseqs(mmseqs, ["lndb", base.joinpath("qdb_h"), base.joinpath("prof_res_h")])
+    # A single iteration computes no profile, then the query sequences themselves are realigned
+    if num_iterations > 1:
+        align_query = base.joinpath("prof_res")
+        mvdb_local(base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res"))
+        lndb_local(base.joinpath("qdb_h"), base.joinpath("prof_res_h"))
+    else:
+        align_query = base.joinpath("qdb")
     run_mmseqs(mmseqs, ["expandaln", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res"), dbbase.joinpath(f"{uniref_db}{dbSuffix2}"), base.joinpath("res_exp"), "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + expand_param)
-    run_mmseqs(mmseqs, ["align", base.joinpath("prof_res"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads", str(threads), "--alt-ali", "10", "-a"])
+    evict_page_cache(base.joinpath("res"))
+    run_mmseqs(mmseqs, ["align", align_query, dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads", str(threads), "--alt-ali", "10", "-a"])
+    evict_page_cache(base.joinpath("res_exp"))
     run_mmseqs(mmseqs, ["filterresult", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
                         base.joinpath("res_exp_realign"), base.joinpath("res_exp_realign_filter"), "--db-load-mode",
                         str(db_load_mode), "--qid", "0", "--qsc", str(qsc), "--diff", "0", "--threads",
                         str(threads), "--max-seq-id", "1.0", "--filter-min-enable", "100"])
+    if not keep_intermediate:
+        # otherwise pairaln of mmseqs_search_pair reads it next
+        evict_page_cache(base.joinpath("res_exp_realign"))
     run_mmseqs(mmseqs, ["result2msa", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
                         base.joinpath("res_exp_realign_filter"), base.joinpath("uniref.a3m"), "--msa-format-mode",
                         "6", "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + filter_param)
+    evict_page_cache(base.joinpath("res_exp_realign_filter"))
     
-    # subprocess.run([mmseqs] + ["rmdb", base.joinpath("res_exp_realign")]) #! save this file as intermediate
-    subprocess.run([mmseqs] + ["rmdb", base.joinpath("res_exp")])  
-    subprocess.run([mmseqs] + ["rmdb", base.joinpath("res")])
-    # subprocess.run([mmseqs] + ["rmdb", base.joinpath("res_exp_realign_filter")])
-    run_mmseqs(mmseqs, ["mvdb", base.joinpath("uniref.a3m"), base.joinpath("final.a3m")])
+    if not keep_intermediate:
+        rmdb_local(base.joinpath("res_exp_realign"))
+    rmdb_local(base.joinpath("res_exp"))
+    rmdb_local(base.joinpath("res"))
+    # rmdb_local(base.joinpath("res_exp_realign_filter"))
+    mvdb_local(base.joinpath("uniref.a3m"), base.joinpath("final.a3m"))
     run_mmseqs(mmseqs, ["unpackdb", base.joinpath("final.a3m"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", ".a3m"])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("final.a3m")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("uniref.a3m")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res")])
+    rmdb_local(base.joinpath("final.a3m"))
+    rmdb_local(base.joinpath("uniref.a3m"))
     # @formatter:on
     # fmt: on
 
-    for file in base.glob("prof_res*"):
-        file.unlink()
+    unlink_prefixed(base, "prof_res")
     shutil.rmtree(base.joinpath("tmp"))
-    if use_templates:
-        shutil.rmtree(base.joinpath("tmp2"))
-    if use_env:
-        shutil.rmtree(base.joinpath("tmp3"))
+
+
+def read_unpacked_msas(
+    base: Path, ids: List[int], suffix: str, max_workers: int = 32
+) -> List[str]:
+    """Read and delete the {id}{suffix} files written by unpackdb, returned in the order of ids.
+
+    The files are small and many, so they are read by a thread pool to keep several reads in flight.
+    """
+
+    def read_and_unlink(id: int) -> str:
+        file = base.joinpath(f"{id}{suffix}")
+        msa = file.read_text()
+        file.unlink()
+        return msa
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_and_unlink, ids))
+
+
+def read_fasta_queries(
+    fasta_file: Path,
+) -> Tuple[List[Tuple[str, Union[str, List[str]], None]], bool]:
+    """Same as get_queries for a single fasta file, but splits the whole file into records at once
+    instead of parsing it line by line"""
+    # Normalize the lines like parse_fasta does: treat \r\n and \r as line breaks (splitlines),
+    # strip leading whitespace and drop comments
+    data = re.sub(rb"\r\n?", b"\n", fasta_file.read_bytes())
+    data = re.sub(rb"(?m)^[ \t]+", b"", data)
+    data = re.sub(rb"(?m)^#.*$", b"", data)
+    queries = []
+    is_complex = False
+    # Anything before the first header is dropped with the first element
+    for record in (b"\n" + data).split(b"\n>")[1:]:
+        header, _, sequence = record.partition(b"\n")
+        header = header.rstrip().decode()
+        # Join the stripped sequence lines, skipping blank ones
+        sequence = re.sub(rb"\s*\n\s*", b"", sequence.strip()).decode().upper()
+        if ":" in sequence:
+            # Complex mode
+            queries.append((header, sequence.split(":"), None))
+            is_complex = True
+        else:
+            queries.append((header, sequence, None))
+    return queries, is_complex
 
 
 def main():
@@ -173,20 +441,110 @@ def main():
         default=Path("mmseqs"),
         help="Location of the mmseqs binary",
     )
+    parser.add_argument(
+        "--num-iterations",
+        type=int,
+        default=None,
+        help="Number of profile search iterations. More iterations find more remote homologs, but each one "
+        "costs about as much as the first search. Defaults to 1 with --filter 1 and -s 4 or lower, otherwise 3",
+    )
     parser.add_argument("--expand-eval", type=float, default=math.inf)
     parser.add_argument("--align-eval", type=int, default=10)
-    parser.add_argument("--diff", type=int, default=3000)
+    parser.add_argument(
+        "--diff",
+        type=int,
+        default=3000,
+        help="Keep at least this many diverse sequences per filtered MSA. Lower values (e.g. 256) write smaller "
+        "MSAs faster, but AlphaFold2 also uses rows beyond the first 512 as extra MSA, so they change predictions",
+    )
+    parser.add_argument(
+        "--filter-min-enable",
+        type=int,
+        default=1000,
+        help="Only filter MSAs with more than this many sequences, smaller ones are written as they are",
+    )
     parser.add_argument("--qsc", type=float, default=-20.0)
     parser.add_argument("--max-accept", type=int, default=1000000)
     parser.add_argument("--pairing_strategy", type=int, default=0)
     parser.add_argument("--db-load-mode", type=int, default=0)
     parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument(
+        "--gpu",
+        type=int,
+        default=None,
+        choices=[0, 1],
+        help="Run the prefilter of MMseqs2 on the GPU. Requires databases built with GPU=1 setup_databases.sh. "
+        "By default, this is enabled if nvidia-smi is found and the UniRef database was built for the GPU",
+    )
+    parser.add_argument(
+        "--gpu-server",
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help="Use an already running `mmseqs gpuserver` instead of loading the database onto the GPU for each search",
+    )
+    parser.add_argument(
+        "--use-shm",
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help="Copy the database index to /dev/shm once and keep it in memory for all MMseqs2 calls",
+    )
+    parser.add_argument(
+        "--mpi-np",
+        type=int,
+        default=1,
+        help="Distribute the prefilter and alignment of the search over this many MPI processes. "
+        "Requires mmseqs compiled with MPI, and both the databases and base (which holds the tmp "
+        "directory) on a filesystem shared by all nodes",
+    )
+    parser.add_argument(
+        "--pin-threads",
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help="Pin the OpenMP threads of mmseqs to consecutive cores (OMP_PROC_BIND=close, OMP_PLACES=cores). "
+        "Only use this if the search has the node to itself: every pinned process starts on the first core, "
+        "so concurrent searches or several MPI ranks on one node would share the same cores",
+    )
     args = parser.parse_args()
 
-    queries, is_complex = get_queries(args.query, None)
-        """Reads a directory of fasta files, a single fasta file or a csv file and returns a tuple
-        of job name, sequence and the optional a3m lines"""
+    if args.mpi_np < 1:
+        parser.error("--mpi-np must be at least 1")
+    if args.use_shm and args.mpi_np > 1:
+        # The staged copy only exists on the node that launches mpirun
+        parser.error("--use-shm cannot be combined with --mpi-np > 1")
+    if args.pin_threads and args.mpi_np > 1:
+        # All ranks on a node would be pinned to the same cores
+        parser.error("--pin-threads cannot be combined with --mpi-np > 1")
 
+    if args.gpu is None:
+        args.gpu = 0
+        if shutil.which("nvidia-smi") is not None:
+            if is_gpu_db(args.dbbase, args.db1):
+                args.gpu = 1
+            else:
+                logger.info(
+                    f"Found a GPU, but {args.db1} was not built for GPU search "
+                    f"(GPU=1 setup_databases.sh), searching on the CPU"
+                )
+    if args.gpu and args.mmseqs == Path("mmseqs"):
+        # The default build from bioconda has no CUDA support
+        args.mmseqs = download_mmseqs_gpu()
+        logger.warning(
+            f"Using the CUDA build {args.mmseqs} instead of the mmseqs on PATH, pass --mmseqs to choose another one"
+        )
+    if args.mpi_np > 1:
+        # The mmseqs workflows launch their parallel steps through RUNNER
+        os.environ["RUNNER"] = f"mpirun -np {args.mpi_np}"
+    if args.pin_threads:
+        os.environ.setdefault("OMP_PROC_BIND", "close")
+        os.environ.setdefault("OMP_PLACES", "cores")
+
+    if args.query.is_file() and args.query.suffix in [".fasta", ".faa", ".fa"]:
+        queries, is_complex = read_fasta_queries(args.query)
+    else:
+        queries, is_complex = get_queries(args.query, None)
 
     queries_unique = []
     for job_number, (raw_jobname, query_sequences, a3m_lines) in enumerate(queries):
@@ -194,46 +552,39 @@ def main():
         query_sequences = (
             [query_sequences] if isinstance(query_sequences, str) else query_sequences
         )
-        query_seqs_unique = []
-        for x in query_sequences:
-            if x not in query_seqs_unique:
-                query_seqs_unique.append(x)
-        query_seqs_cardinality = [0] * len(query_seqs_unique)
-        for seq in query_sequences:
-            seq_idx = query_seqs_unique.index(seq)
-            query_seqs_cardinality[seq_idx] += 1
+        # Counter keeps the order of first occurrence
+        seq_counts = Counter(query_sequences)
+        query_seqs_unique = list(seq_counts)
+        query_seqs_cardinality = [seq_counts[seq] for seq in query_seqs_unique]
 
         queries_unique.append([raw_jobname, query_seqs_unique, query_seqs_cardinality])
 
+    # All jobs go into a single query database, so the target database is only scanned once.
+    # The input order is kept, unpackdb names the resulting MSAs after the query ids.
+
     args.base.mkdir(exist_ok=True, parents=True)
     query_file = args.base.joinpath("query.fas")
-    with query_file.open("w") as f:
-        for job_number, (
-            raw_jobname,
-            query_sequences,
-            query_seqs_cardinality,
-        ) in enumerate(queries_unique):
-            for j, seq in enumerate(query_sequences):
-                # The header of first sequence set as 101
-                query_seq_headername = 101 + j
-                f.write(f">{query_seq_headername}\n{seq}\n")
+    fasta_lines = []
+    lookup_lines = []
+    id = 0
+    for file_number, (
+        raw_jobname,
+        query_sequences,
+        query_seqs_cardinality,
+    ) in enumerate(queries_unique):
+        for j, seq in enumerate(query_sequences):
+            # The header of first sequence set as 101
+            fasta_lines.append(">%d\n%s\n" % (101 + j, seq))
+            lookup_lines.append("%d\t%s\t%d\n" % (id, raw_jobname, file_number))
+            id += 1
+    query_file.write_text("".join(fasta_lines))
 
     run_mmseqs(
         args.mmseqs,
         ["createdb", query_file, args.base.joinpath("qdb"), "--shuffle", "0"],
     )
-    with args.base.joinpath("qdb.lookup").open("w") as f:
-        id = 0
-        file_number = 0
-        for job_number, (
-            raw_jobname,
-            query_sequences,
-            query_seqs_cardinality,
-        ) in enumerate(queries_unique):
-            for seq in query_sequences:
-                f.write(f"{id}\t{raw_jobname}\t{file_number}\n")
-                id += 1
-            file_number += 1
+    # createdb writes its own lookup, so ours has to be written afterwards
+    args.base.joinpath("qdb.lookup").write_text("".join(lookup_lines))
 
     mmseqs_search_monomer(
         mmseqs=args.mmseqs,
@@ -248,12 +599,18 @@ def main():
         expand_eval=args.expand_eval,
         align_eval=args.align_eval,
         diff=args.diff,
+        filter_min_enable=args.filter_min_enable,
         qsc=args.qsc,
         max_accept=args.max_accept,
         s=args.s,
+        num_iterations=args.num_iterations,
         db_load_mode=args.db_load_mode,
         threads=args.threads,
+        gpu=args.gpu,
+        gpu_server=args.gpu_server,
+        use_shm=args.use_shm,
     )
+    # Pass keep_intermediate=is_complex to mmseqs_search_monomer above when enabling this
     # if is_complex is True:
     #     mmseqs_search_pair(
     #         mmseqs=args.mmseqs,
@@ -264,27 +621,23 @@ def main():
     #         db_load_mode=args.db_load_mode,
     #         threads=args.threads,
     #         pairing_strategy=args.pairing_strategy,
+    #         use_shm=args.use_shm,
     #     )
 
+    #     ids = list(range(len(lookup_lines)))
+    #     unpaired_msas = read_unpacked_msas(args.base, ids, ".a3m")
+    #     paired_msas = read_unpacked_msas(args.base, ids, ".paired.a3m")
     #     id = 0
     #     for job_number, (
     #         raw_jobname,
     #         query_sequences,
     #         query_seqs_cardinality,
     #     ) in enumerate(queries_unique):
-    #         unpaired_msa = []
+    #         unpaired_msa = unpaired_msas[id : id + len(query_sequences)]
     #         paired_msa = None
     #         if len(query_seqs_cardinality) > 1:
-    #             paired_msa = []
-    #         for seq in query_sequences:
-    #             with args.base.joinpath(f"{id}.a3m").open("r") as f:
-    #                 unpaired_msa.append(f.read())
-    #             args.base.joinpath(f"{id}.a3m").unlink()
-    #             if len(query_seqs_cardinality) > 1:
-    #                 with args.base.joinpath(f"{id}.paired.a3m").open("r") as f:
-    #                     paired_msa.append(f.read())
-    #             args.base.joinpath(f"{id}.paired.a3m").unlink()
-    #             id += 1
+    #             paired_msa = paired_msas[id : id + len(query_sequences)]
+    #         id += len(query_sequences)
     #         msa = msa_to_str(
     #             unpaired_msa, paired_msa, query_sequences, query_seqs_cardinality
     #         )
@@ -301,8 +654,7 @@ def main():
     #             )
 
     query_file.unlink()
-    run_mmseqs(args.mmseqs, ["rmdb", args.base.joinpath("qdb")])
-    run_mmseqs(args.mmseqs, ["rmdb", args.base.joinpath("qdb_h")])
+    rmdb_local(args.base.joinpath("qdb"))
 
 
 if __name__ == "__main__":
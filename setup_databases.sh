@@ -1,6 +1,7 @@
 #!/bin/bash -ex
 # Setup everything for using mmseqs locally
 # Set MMSEQS_NO_INDEX to skip the index creation step (not useful for colabfold_search in most cases)
+# Set GPU=1 to build the padded databases and indices required by colabfold_search --gpu 1
 ARIA_NUM_CONN=8
 WORKDIR="${1:-$(pwd)}"
 
@@ -8,6 +9,14 @@ PDB_SERVER="${2:-"rsync.wwpdb.org::ftp"}"
 PDB_PORT="${3:-"33444"}"
 UNIREF30DB="uniref30_2302"
 MMSEQS_NO_INDEX=${MMSEQS_NO_INDEX:-}
+GPU=${GPU:-}
+
+GPU_PAR=""
+GPU_INDEX_PAR=""
+if [ -n "${GPU}" ]; then
+  GPU_PAR="--gpu 1"
+  GPU_INDEX_PAR="--split 1 --index-subset 2"
+fi
 
 cd "${WORKDIR}"
 
@@ -52,9 +61,9 @@ export MMSEQS_FORCE_MERGE=1
 if [ ! -f UNIREF30_READY ]; then
   downloadFile "https://wwwuser.gwdg.de/~compbiol/colabfold/${UNIREF30DB}.tar.gz" "${UNIREF30DB}.tar.gz"
   tar xzvf "${UNIREF30DB}.tar.gz"
-  mmseqs tsv2exprofiledb "${UNIREF30DB}" "${UNIREF30DB}_db"
+  mmseqs tsv2exprofiledb "${UNIREF30DB}" "${UNIREF30DB}_db" ${GPU_PAR}
   if [ -z "$MMSEQS_NO_INDEX" ]; then
-    mmseqs createindex "${UNIREF30DB}_db" tmp1 --remove-tmp-files 1
+    mmseqs createindex "${UNIREF30DB}_db" tmp1 --remove-tmp-files 1 ${GPU_INDEX_PAR}
   fi
   if [ -e ${UNIREF30DB}_db_mapping ]; then
     ln -sf ${UNIREF30DB}_db_mapping ${UNIREF30DB}_db.idx_mapping
@@ -68,10 +77,10 @@ fi
 if [ ! -f COLABDB_READY ]; then
   downloadFile "https://wwwuser.gwdg.de/~compbiol/colabfold/colabfold_envdb_202108.tar.gz" "colabfold_envdb_202108.tar.gz"
   tar xzvf "colabfold_envdb_202108.tar.gz"
-  mmseqs tsv2exprofiledb "colabfold_envdb_202108" "colabfold_envdb_202108_db"
+  mmseqs tsv2exprofiledb "colabfold_envdb_202108" "colabfold_envdb_202108_db" ${GPU_PAR}
   # TODO: split memory value for createindex?
   if [ -z "$MMSEQS_NO_INDEX" ]; then
-    mmseqs createindex "colabfold_envdb_202108_db" tmp2 --remove-tmp-files 1
+    mmseqs createindex "colabfold_envdb_202108_db" tmp2 --remove-tmp-files 1 ${GPU_INDEX_PAR}
   fi
   touch COLABDB_READY
 fi
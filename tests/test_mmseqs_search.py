@@ -0,0 +1,94 @@
+import pytest
+
+from colabfold.batch import get_queries, parse_fasta
+from colabfold.mmseqs.search_monomer import (
+    lndb_local,
+    mvdb_local,
+    read_fasta_queries,
+    rmdb_local,
+)
+
+
+@pytest.mark.parametrize(
+    "fasta",
+    [
+        ">5AWL_1\nYYDPETGTWY\n>6A5J\nIKKILSKIKKLLK\n",
+        "#comment\n>q1\nAC\n  >q2\nKLM\n",
+        "> q1 desc \r\nac de\r\n\r\n  # comment\n fg:hi \n>q2\n",
+        ">3G5O_A_3G5O_B\nMRILPIST\nIKGKLNEF:MPYTVRFT\nTTARRDLH\n\n>empty\n",
+        ">a\rAC\r>b\rKK\r",
+    ],
+)
+def test_read_fasta_queries(tmp_path, fasta):
+    fasta_file = tmp_path.joinpath("query.fasta")
+    fasta_file.write_text(fasta)
+
+    queries, is_complex = read_fasta_queries(fasta_file)
+
+    sequences, headers = parse_fasta(fasta)
+    assert [query[0] for query in queries] == headers
+    assert [
+        ":".join(query[1]) if isinstance(query[1], list) else query[1]
+        for query in queries
+    ] == [sequence.upper() for sequence in sequences]
+    assert (queries, is_complex) == get_queries(fasta_file, None)
+
+
+def test_rmdb_local(tmp_path):
+    # res is written in two parts, res_exp and resfoo only share its prefix
+    for name in [
+        "res.0",
+        "res.1",
+        "res.index",
+        "res.dbtype",
+        "res_exp",
+        "res_exp.index",
+        "resfoo",
+    ]:
+        tmp_path.joinpath(name).write_text(name)
+
+    rmdb_local(tmp_path.joinpath("res"))
+
+    assert sorted(file.name for file in tmp_path.iterdir()) == [
+        "res_exp",
+        "res_exp.index",
+        "resfoo",
+    ]
+
+
+def test_mvdb_local(tmp_path):
+    for name in ["profile_1.0", "profile_1.1", "profile_1.index", "profile_1.dbtype"]:
+        tmp_path.joinpath(name).write_text(name)
+
+    mvdb_local(tmp_path.joinpath("profile_1"), tmp_path.joinpath("prof_res"))
+
+    assert sorted(file.name for file in tmp_path.iterdir()) == [
+        "prof_res.0",
+        "prof_res.1",
+        "prof_res.dbtype",
+        "prof_res.index",
+    ]
+    assert tmp_path.joinpath("prof_res.1").read_text() == "profile_1.1"
+
+
+def test_mvdb_local_missing(tmp_path):
+    tmp_path.joinpath("profile_1.index").write_text("")
+
+    with pytest.raises(FileNotFoundError):
+        mvdb_local(tmp_path.joinpath("profile_1"), tmp_path.joinpath("prof_res"))
+
+
+def test_lndb_local(tmp_path):
+    for name in ["qdb_h", "qdb_h.index", "qdb_h.dbtype"]:
+        tmp_path.joinpath(name).write_text(name)
+    # left over from an earlier run whose target is gone
+    tmp_path.joinpath("prof_res_h").symlink_to(tmp_path.joinpath("removed_h"))
+
+    # linking again into the same directory must not fail
+    lndb_local(tmp_path.joinpath("qdb_h"), tmp_path.joinpath("prof_res_h"))
+    lndb_local(tmp_path.joinpath("qdb_h"), tmp_path.joinpath("prof_res_h"))
+
+    for suffix in ["", ".index", ".dbtype"]:
+        link = tmp_path.joinpath(f"prof_res_h{suffix}")
+        assert link.is_symlink()
+        assert link.read_text() == f"qdb_h{suffix}"